@@ -1,15 +1,16 @@
-import json
+import http.client
 import logging
 import os
+import signal
+import threading
 import time
-from abc import ABC
 from enum import Enum
 from typing import Any, override
 
+import orjson
 import paho.mqtt.client as mqtt
-import requests
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 
 class DataType(Enum):
@@ -17,59 +18,105 @@ class DataType(Enum):
     INFORMATION = "Information"
 
 
-status_map: dict[int, str] = {
-    0: "Waiting",
-    1: "Checking",
-    2: "Normal",
-    3: "Off",
-    4: "Permanent Fault",
-    5: "Updating",
-    6: "EPS Check",
-    7: "EPS Mode",
-    8: "Self Test",
-    9: "Idle",
-    10: "Standby",
-}
+# Indexed by the inverter's operation mode register
+status_names: tuple[str, ...] = (
+    "Waiting",
+    "Checking",
+    "Normal",
+    "Off",
+    "Permanent Fault",
+    "Updating",
+    "EPS Check",
+    "EPS Mode",
+    "Self Test",
+    "Idle",
+    "Standby",
+)
+
+# Set on every (re)connect to force a full publish on the next tick
+_RESYNC = threading.Event()
+
+# Published to the status topic while the inverter is unreachable
+_OFFLINE_PAYLOAD = b"Offline"
+
+# Publish all states every N ticks, otherwise only the ones that changed
+FULL_PUBLISH_INTERVAL = 60
+
+
+def to_int16(v: int) -> int:
+    # Reinterpret an unsigned 16-bit register as two's complement
+    return ((v + 0x8000) & 0xFFFF) - 0x8000
+
+
+class Entity:
+    # Fixed attribute layout keeps the per-tick attribute reads cheap
+    __slots__ = (
+        "id",
+        "topic",
+        "config_topic",
+        "state_class",
+        "name",
+        "device_class",
+        "icon",
+        "unit",
+        "idx",
+        "factor",
+        "state",
+        "_last_published",
+        "data_type",
+        "skip_init",
+        "ha_config_payload",
+    )
 
-
-class Entity(ABC):
     def __init__(
         self,
         name: str,
         device_class: str | None,
         icon: str,
-        idx: float,
+        idx: int,
         factor: int,
         unit: str | None,
         data_type: DataType = DataType.DATA,
         skip_init: bool = False,
+        state_class: str | None = "measurement",
     ):
-        self.id = "solax_" + name.replace(" ", "_").replace("-", "").lower()
+        self.id = self._build_id(name)
         self.topic = f"homeassistant/sensor/{self.id}/state"
         self.config_topic = f"homeassistant/sensor/{self.id}/config"
-        self.state_class = "measurement"
+        self.state_class = state_class
         self.name = name
         self.device_class = device_class
         self.icon = icon
         self.unit = unit
-        self.idx = idx
+        self.idx = int(idx)
         self.factor = factor
-        self._state = 0
+        self.state = 0
+        self._last_published = object()
         self.data_type = data_type
         self.skip_init = skip_init
+        self.ha_config_payload = orjson.dumps(
+            self._build_ha_config(), option=orjson.OPT_SORT_KEYS
+        )
+
+    def _build_id(self, name: str) -> str:
+        return "solax_" + name.replace(" ", "_").replace("-", "").lower()
 
     @property
-    def state(self):
-        return self._state
+    def indices(self) -> tuple[int, ...]:
+        return (self.idx,)
 
-    @state.setter
-    def state(self, value: dict):
-        self._state = value[self.data_type.value][self.idx] / self.factor
-        if self.skip_init and self._state == 0:
+    def update(self, values: list[int]):
+        self.state = values[self.idx] / self.factor
+        if self.skip_init and self.state == 0:
             raise ValueError("Initialization value")
 
-    @property
-    def ha_config(self) -> dict:
+    def changed(self, force: bool = False) -> bool:
+        return force or self.state != self._last_published
+
+    def mark_published(self, value: Any):
+        self._last_published = value
+
+    def _build_ha_config(self) -> dict:
         config = {
             "state_topic": self.topic,
             "name": self.name,
@@ -91,34 +138,44 @@ class Entity(ABC):
 
 
 class EnergyEntity(Entity):
+    __slots__ = ()
+
     def __init__(
         self,
         name: str,
         icon: str,
-        idx: float,
+        idx: int,
         factor: int,
         skip_init: bool = False,
     ):
-        super().__init__(name, "energy", icon, idx, factor, "kWh", skip_init=skip_init)
-        self.state_class = "total_increasing"
+        super().__init__(
+            name,
+            "energy",
+            icon,
+            idx,
+            factor,
+            "kWh",
+            skip_init=skip_init,
+            state_class="total_increasing",
+        )
 
 
 class PowerEntity(Entity):
-    def __init__(self, name: str, icon: str, idx: float):
-        super().__init__(name, "power", icon, idx, 1, "W")
+    __slots__ = ()
 
-    @property
-    def state(self):
-        return self._state
+    def __init__(self, name: str, icon: str, idx: int):
+        super().__init__(name, "power", icon, idx, 1, "W")
 
-    @state.setter
-    def state(self, value: dict):
-        v = value[self.data_type.value][self.idx] / self.factor
-        self._state = v if v < 32768 else v - 65536
+    @override
+    def update(self, values: list[int]):
+        raw = values[self.idx]
+        self.state = to_int16(raw) / self.factor
 
 
 class FrequencyEntity(Entity):
-    def __init__(self, name: str, idx: float, skip_init: bool = False):
+    __slots__ = ()
+
+    def __init__(self, name: str, idx: int, skip_init: bool = False):
         super().__init__(
             name,
             "frequency",
@@ -131,72 +188,81 @@ class FrequencyEntity(Entity):
 
 
 class VoltageEntity(Entity):
-    def __init__(self, name: str, idx: float, skip_init: bool = False):
+    __slots__ = ()
+
+    def __init__(self, name: str, idx: int, skip_init: bool = False):
         super().__init__(
             name, "voltage", "mdi:current-ac", idx, 10, "V", skip_init=skip_init
         )
 
 
 class CurrentEntity(Entity):
-    def __init__(self, name: str, idx: float):
+    __slots__ = ()
+
+    def __init__(self, name: str, idx: int):
         super().__init__(name, "current", "mdi:current-ac", idx, 10, "A")
 
 
 class TemperatureEntity(Entity):
-    def __init__(self, name: str, idx: float):
+    __slots__ = ()
+
+    def __init__(self, name: str, idx: int):
         super().__init__(name, "temperature", "mdi:thermometer", idx, 1, "°C")
 
 
 class StatusEntity(Entity):
-    def __init__(self, name: str, idx: float):
-        super().__init__(name, None, "mdi:check", idx, 1, None)
-        self.state_class = None
+    __slots__ = ()
 
-    @property
-    def state(self):
-        return self._state
+    def __init__(self, name: str, idx: int):
+        super().__init__(name, None, "mdi:check", idx, 1, None, state_class=None)
 
-    @state.setter
-    def state(self, value: dict):
-        v = value[self.data_type.value][self.idx] / self.factor
-        self._state = status_map.get(v, "Unknown")
+    @override
+    def update(self, values: list[int]):
+        v = values[self.idx]
+        self.state = status_names[v] if 0 <= v < len(status_names) else "Unknown"
 
 
 class PowerCalcEntity(PowerEntity):
-    def __init__(self, name: str, icon: str, idx1: float, idx2: float):
+    __slots__ = ("idx2",)
+
+    def __init__(self, name: str, icon: str, idx1: int, idx2: int):
         super().__init__(name, icon, idx1)
-        self.id = name.replace(" ", "_").replace("-", "").lower()
-        self.topic = f"homeassistant/sensor/{self.id}/state"
-        self.config_topic = f"homeassistant/sensor/{self.id}/config"
-        self.idx2 = idx2
+        self.idx2 = int(idx2)
+
+    @override
+    def _build_id(self, name: str) -> str:
+        return name.replace(" ", "_").replace("-", "").lower()
 
+    @override
     @property
-    def state(self):
-        return self._state
+    def indices(self) -> tuple[int, ...]:
+        return (self.idx, self.idx2)
 
-    @state.setter
-    def state(self, value: dict):
-        ac = value[self.data_type.value][self.idx] / self.factor
-        feedin_aux = value[self.data_type.value][self.idx2] / self.factor
-        feedin_power = feedin_aux if feedin_aux < 32768 else feedin_aux - 65536
-        self._state = ac - feedin_power
+    @override
+    def update(self, values: list[int]):
+        ac = values[self.idx] / self.factor
+        raw = values[self.idx2]
+        feedin_power = to_int16(raw) / self.factor
+        self.state = ac - feedin_power
 
     @override
-    @property
-    def ha_config(self) -> dict:
-        config = super().ha_config
+    def _build_ha_config(self) -> dict:
+        config = super()._build_ha_config()
         config["object_id"] = self.id
         return config
 
 
 class VersionEntity(Entity):
-    def __init__(self, name: str, idx: float):
+    # Versions rarely change and are only re-sent by the periodic full publish,
+    # so they would be a candidate for QoS 1 if a lost update became a problem
+    __slots__ = ()
+
+    def __init__(self, name: str, idx: int):
         super().__init__(name, None, "mdi:sync", idx, 1, None, DataType.INFORMATION)
 
     @override
-    @property
-    def ha_config(self) -> dict:
-        config = super().ha_config
+    def _build_ha_config(self) -> dict:
+        config = super()._build_ha_config()
         config["entity_category"] = "diagnostic"
         return config
 
@@ -222,47 +288,180 @@ entities = [
 ]
 
 
+def required_indices(data_type: DataType) -> tuple[int, ...]:
+    return tuple(
+        sorted(
+            {
+                idx
+                for entity in entities
+                if entity.data_type is data_type
+                for idx in entity.indices
+            }
+        )
+    )
+
+
+# Registers a payload must provide so every entity can be decoded
+_REQUIRED_INDICES = {data_type: required_indices(data_type) for data_type in DataType}
+
+
+def is_valid_payload(data: Any) -> bool:
+    # Checks that every register the entities read exists and is an integer.
+    # Register values themselves (e.g. out-of-range codes) are left to update()
+    if not isinstance(data, dict):
+        return False
+    for data_type, indices in _REQUIRED_INDICES.items():
+        values = data.get(data_type.value)
+        if not isinstance(values, list) or len(values) <= max(indices, default=-1):
+            return False
+        if not all(isinstance(values[idx], int) for idx in indices):
+            return False
+    return True
+
+
+def decode_states(data: dict, force: bool = False) -> list[Entity]:
+    data_values = data["Data"]
+    information_values = data["Information"]
+    changed = []
+    for entity in entities:
+        try:
+            if entity.data_type is DataType.DATA:
+                entity.update(data_values)
+            else:
+                entity.update(information_values)
+            if entity.changed(force):
+                changed.append(entity)
+        except ValueError:
+            logger.warning("Skipping %s initialization value", entity.name)
+    return changed
+
+
+# Reuse a single keep-alive connection to the inverter across polls
+_CONN: http.client.HTTPConnection | None = None
+
+
+def close_solax_connection():
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+
+def post_solax(conn: http.client.HTTPConnection, body: str) -> tuple[int, bytes]:
+    conn.request("POST", "/", body=body, headers={"Connection": "keep-alive"})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
 def fetch_solax_data(ip: str, password: str) -> dict | None:
+    global _CONN
+    body = f"?optType=ReadRealTimeData&pwd={password}"
     try:
-        response = requests.post(
-            f"http://{ip}", data=f"?optType=ReadRealTimeData&pwd={password}", timeout=5
-        )
-        response.raise_for_status()
-        return response.json()
-    except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError):
+        reused = _CONN is not None
+        if not reused:
+            _CONN = http.client.HTTPConnection(ip, timeout=5)
+        try:
+            status, content = post_solax(_CONN, body)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            if not reused:
+                raise
+            # The inverter dropped the idle connection, retry once on a new one
+            close_solax_connection()
+            _CONN = http.client.HTTPConnection(ip, timeout=5)
+            status, content = post_solax(_CONN, body)
+        if status >= 400:
+            logger.error("SolaX request error: HTTP %s", status)
+            return None
+        data = orjson.loads(content)
+        if not is_valid_payload(data):
+            logger.error("SolaX request error: unexpected payload")
+            return None
+        return data
+    except (http.client.HTTPException, OSError):
+        close_solax_connection()
         return None
     except Exception as err:
-        logging.error(f"SolaX request error: {type(err)}")
+        logger.error("SolaX request error: %s", type(err))
         return None
 
 
+def on_connect(client, userdata, flags, reason_code, properties):
+    if not reason_code.is_failure:
+        _RESYNC.set()
+
+
 def connect_mqtt(
     broker: str,
     username: str = None,
     password: str = None,
 ) -> mqtt.Client | None:
-    client = mqtt.Client()
+    client = mqtt.Client(
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+        protocol=mqtt.MQTTv5,
+    )
     client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.on_connect = on_connect
 
     if username and password:
         client.username_pw_set(username, password)
     try:
-        client.connect(broker)
-        client.on_disconnect = lambda client, userdata, rc: client.reconnect()
+        client.connect(broker, keepalive=60)
+        # The network thread handles keep-alive and reconnects on its own
+        client.loop_start()
         return client
     except Exception as err:
-        logging.error(f"MQTT connection error: {err}")
+        logger.error("MQTT connection error: %s", err)
         return None
 
 
-def publish_to_mqtt(client: mqtt.Client, topic: str, value: Any, retain: bool = False):
+def fetch_retained_configs(
+    client: mqtt.Client, timeout: float = 1.0
+) -> dict[str, bytes]:
+    retained: dict[str, bytes] = {}
+
+    def on_message(client, userdata, msg):
+        if msg.retain:
+            retained[msg.topic] = msg.payload
+
+    client.on_message = on_message
+    client.subscribe("homeassistant/sensor/+/config", qos=1)
+
+    time.sleep(timeout)
+
+    # Unsubscribe before discovery so our own publishes are not echoed back
+    client.unsubscribe("homeassistant/sensor/+/config")
+    client.on_message = None
+    return retained
+
+
+def publish_to_mqtt(
+    client: mqtt.Client,
+    topic: str,
+    value: Any,
+    qos: int = 0,
+    retain: bool = False,
+) -> bool:
     try:
-        client.publish(topic, value, retain=retain)
+        info = client.publish(topic, value, qos=qos, retain=retain)
     except Exception as err:
-        logging.error(f"MQTT publish error: {err}")
+        logger.error("MQTT publish error: %s", err)
+        return False
+    # paho drops the message instead of queueing it while disconnected
+    return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+
+def publish_many_to_mqtt(client: mqtt.Client, changed: list[Entity]):
+    # Publish each changed state in turn. States are retained so Home Assistant
+    # gets the last value as soon as it subscribes, and sent at QoS 0 since a
+    # lost measurement is replaced on the next tick
+    for entity in changed:
+        if publish_to_mqtt(client, entity.topic, entity.state, qos=0, retain=True):
+            entity.mark_published(entity.state)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     solax_ip = os.environ.get("SOLAX_IP")
     solax_password = os.environ.get("SOLAX_PASSWORD")
     mqtt_ip = os.environ.get("MQTT_IP")
@@ -271,44 +470,65 @@ if __name__ == "__main__":
     time_delay = int(os.environ.get("TIME_DELAY", 5))
     offline_delay = int(os.environ.get("OFFLINE_DELAY", 60))
 
+    if not solax_ip:
+        logger.error("SOLAX_IP is not set")
+        exit(1)
+
     client = connect_mqtt(mqtt_ip, mqtt_username, mqtt_password)
 
     if client is None:
         exit(1)
 
-    # Configure MQTT Discovery in Home Assistant
+    # Configure MQTT Discovery in Home Assistant, skipping already retained configs
+    retained_configs = fetch_retained_configs(client)
     for entity in entities:
-        publish_to_mqtt(
-            client,
-            entity.config_topic,
-            json.dumps(entity.ha_config),
-            retain=True,
-        )
+        if retained_configs.get(entity.config_topic) != entity.ha_config_payload:
+            publish_to_mqtt(
+                client,
+                entity.config_topic,
+                entity.ha_config_payload,
+                qos=1,
+                retain=True,
+            )
 
     retries = 0
+    ticks = 0
 
-    while True:
-        try:
+    # Stop on SIGTERM (docker stop) the same way as on Ctrl+C. The handler only
+    # raises KeyboardInterrupt, so it never blocks on a lock the loop holds
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        while True:
+            tick_start = time.monotonic()
             data = fetch_solax_data(solax_ip, solax_password)
 
             if data is None:
                 if (retries := retries + 1) > 3:
-                    logging.info(
-                        f"Inverter is offline. Retrying in {offline_delay} seconds."
+                    logger.info(
+                        "Inverter is offline. Retrying in %d seconds.", offline_delay
                     )
-                    publish_to_mqtt(client, status.topic, "Offline")
+                    if publish_to_mqtt(
+                        client, status.topic, _OFFLINE_PAYLOAD, qos=0, retain=True
+                    ):
+                        status.mark_published(_OFFLINE_PAYLOAD)
                     time.sleep(offline_delay)
                     continue
             else:
                 retries = 0
-                for entity in entities:
-                    try:
-                        entity.state = data
-                        publish_to_mqtt(client, entity.topic, entity.state)
-                    except ValueError:
-                        logging.warning(f"Skipping {entity.name} initialization value")
-            time.sleep(time_delay)
-        except KeyboardInterrupt:
-            break
-
+                # Periodically re-publish everything in case an update was missed,
+                # and after a reconnect since the broker may have lost retained states
+                force = ticks % FULL_PUBLISH_INTERVAL == 0
+                if _RESYNC.is_set():
+                    _RESYNC.clear()
+                    force = True
+                ticks += 1
+                publish_many_to_mqtt(client, decode_states(data, force))
+            # Poll on a fixed cadence, request and publish time included
+            time.sleep(max(0.0, time_delay - (time.monotonic() - tick_start)))
+    except KeyboardInterrupt:
+        pass
+
+    close_solax_connection()
     client.disconnect()
+    client.loop_stop()